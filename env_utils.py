@@ -0,0 +1,65 @@
+"""Utilidades compartidas por los scripts MCP (task_15/task_16): carga ligera de .env y logs.
+
+Evita importar python-dotenv en los subprocesos MCP, que se arrancan en cada `stdio_client`.
+"""
+
+import logging
+import os
+import re
+from pathlib import Path
+from typing import TextIO
+
+
+_ENV_LINE = re.compile(r"^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*?)\s*$")
+_ENV_LOADED = False
+
+
+def cargar_env() -> None:
+    """Carga variables desde .env (sin depender de python-dotenv).
+
+    - No sobreescribe variables ya definidas en el entorno.
+    - Soporta valores entre comillas simples o dobles.
+    - Idempotente: el fichero solo se lee y se parsea la primera vez.
+    """
+
+    global _ENV_LOADED
+    if _ENV_LOADED:
+        return
+    _ENV_LOADED = True
+
+    env_path = Path(__file__).resolve().parent / ".env"
+    if not env_path.exists():
+        return
+
+    # Las líneas vacías, los comentarios y las líneas sin "=" no casan con _ENV_LINE
+    pares = [m.groups() for m in map(_ENV_LINE.match, env_path.read_text(encoding="utf-8-sig").splitlines()) if m]
+
+    for key, value in pares:
+        value = value.strip("\ufeff")
+
+        if key in os.environ:
+            continue
+
+        if (value.startswith('"') and value.endswith('"')) or (value.startswith("'") and value.endswith("'")):
+            value = value[1:-1]
+
+        os.environ[key] = value
+
+
+def configurar_log(nombre: str, stream: TextIO) -> logging.Logger:
+    """Configura solo el logger `nombre` para escribir mensajes sin formato en `stream`.
+
+    - El nivel se toma de MCP_LOG (INFO por defecto o si el valor no es un nivel válido).
+    - No propaga al root, así que los logs de httpx/openai/mcp quedan como estén.
+    - En los servidores el stream debe ser stderr: stdout lleva los mensajes MCP.
+    """
+
+    log = logging.getLogger(nombre)
+    if not log.handlers:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+    log.propagate = False
+    nivel = logging.getLevelName(os.getenv("MCP_LOG", "INFO").upper())
+    log.setLevel(nivel if isinstance(nivel, int) else logging.INFO)
+    return log
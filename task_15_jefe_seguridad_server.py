@@ -1,14 +1,18 @@
 import os
 import sys
+import importlib.util
 import asyncio
 import anyio
-from dotenv import load_dotenv
 from mcp.server.stdio import stdio_server
 from agent_framework import ChatAgent
 from agent_framework.openai import OpenAIChatClient
+from env_utils import cargar_env, configurar_log
 
 # Cargar configuración
-load_dotenv()
+cargar_env()
+
+# Banners a stderr: stdout es el canal MCP. MCP_LOG=WARNING los oculta.
+log = configurar_log("mcp.startup", sys.stderr)
 
 base_url = os.getenv("AZURE_OPENAI_ENDPOINT")
 api_key = os.getenv("AZURE_OPENAI_API_KEY")
@@ -61,13 +65,13 @@ async def run_mcp_server():
     El agente se expone como herramienta MCP tool que los clientes pueden invocar.
     """
     # IMPORTANTE: Los logs van a stderr, stdout es solo para mensajes MCP
-    print("="*80, file=sys.stderr, flush=True)
-    print("🚀 SERVIDOR MCP: Jefe de Seguridad de la Flota Estelar", file=sys.stderr, flush=True)
-    print("="*80, file=sys.stderr, flush=True)
-    print(f"✅ Servidor iniciado: {server}", file=sys.stderr, flush=True)
-    print(f"✅ Agente: {agente_jefe_seguridad.name}", file=sys.stderr, flush=True)
-    print("📡 Escuchando en stdin/stdout (protocolo MCP)", file=sys.stderr, flush=True)
-    print("⏳ Esperando conexiones de clientes MCP...\n", file=sys.stderr, flush=True)
+    log.info("="*80)
+    log.info("🚀 SERVIDOR MCP: Jefe de Seguridad de la Flota Estelar")
+    log.info("="*80)
+    log.info(f"✅ Servidor iniciado: {server}")
+    log.info(f"✅ Agente: {agente_jefe_seguridad.name}")
+    log.info("📡 Escuchando en stdin/stdout (protocolo MCP)")
+    log.info("⏳ Esperando conexiones de clientes MCP...\n")
     
     # Ejecutar servidor con protocolo MCP en stdio
     async with stdio_server() as (read_stream, write_stream):
@@ -78,10 +82,12 @@ async def run_mcp_server():
         )
 
 if __name__ == "__main__":
+    # uvloop (si está instalado) para el stdio del servidor; en Windows no existe
+    usar_uvloop = importlib.util.find_spec("uvloop") is not None
     try:
-        anyio.run(run_mcp_server)
+        anyio.run(run_mcp_server, backend_options={"use_uvloop": usar_uvloop})
     except KeyboardInterrupt:
-        print("\n\n🛑 Servidor MCP detenido por el usuario", file=sys.stderr, flush=True)
+        log.info("\n\n🛑 Servidor MCP detenido por el usuario")
     except Exception as e:
-        print(f"\n❌ Error en servidor MCP: {e}", file=sys.stderr, flush=True)
+        log.error(f"\n❌ Error en servidor MCP: {e}")
         raise
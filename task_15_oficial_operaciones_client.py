@@ -1,6 +1,13 @@
 import asyncio
+import importlib.util
+import logging
+import os
+import sys
 from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
+from mcp.client.stdio import get_default_environment, stdio_client
+from env_utils import configurar_log
+
+log = logging.getLogger("mcp.cliente")
 
 async def consultar_jefe_seguridad():
     """Cliente que se conecta al servidor MCP del Jefe de Seguridad.
@@ -9,16 +16,17 @@ async def consultar_jefe_seguridad():
     El Oficial de Operaciones consulta al Jefe de Seguridad sobre decisiones críticas.
     """
     
-    print("="*80)
-    print("🚀 CLIENTE MCP: Oficial de Operaciones - Enterprise")
-    print("="*80)
-    print("\n📡 Conectando al servidor MCP del Jefe de Seguridad...")
+    log.info("="*80)
+    log.info("🚀 CLIENTE MCP: Oficial de Operaciones - Enterprise")
+    log.info("="*80)
+    log.info("\n📡 Conectando al servidor MCP del Jefe de Seguridad...")
     
     # Parámetros para conectar al servidor
     server_params = StdioServerParameters(
         command="python",
         args=["task_15_jefe_seguridad_server.py"],
-        env=None
+        # Entorno mínimo de MCP + MCP_LOG, para poder ajustar los logs del servidor desde la shell
+        env={**get_default_environment(), **({"MCP_LOG": os.environ["MCP_LOG"]} if "MCP_LOG" in os.environ else {})}
     )
     
     try:
@@ -29,15 +37,15 @@ async def consultar_jefe_seguridad():
                 # Inicializar sesión MCP
                 await session.initialize()
                 
-                print("✅ Conexión establecida con Jefe de Seguridad (servidor MCP)\n")
+                log.info("✅ Conexión establecida con Jefe de Seguridad (servidor MCP)\n")
                 
                 # Listar herramientas disponibles del servidor
                 tools = await session.list_tools()
                 tool_names = [t.name for t in tools.tools]
-                print(f"🔧 Herramientas disponibles: {tool_names}\n")
+                log.info(f"🔧 Herramientas disponibles: {tool_names}\n")
                 
                 if not tool_names:
-                    print("⚠️  No hay herramientas disponibles en el servidor")
+                    log.warning("⚠️  No hay herramientas disponibles en el servidor")
                     return
                     
                 # Consulta del Oficial de Operaciones sobre cambio crítico
@@ -49,7 +57,7 @@ async def consultar_jefe_seguridad():
                 
                 # Usar la primera herramienta disponible (el agente mismo)
                 tool_name = tool_names[0]
-                print(f"📞 Llamando a herramienta: {tool_name}\n")
+                log.info(f"📞 Llamando a herramienta: {tool_name}\n")
                 
                 # Llamar al servidor MCP con el argumento correcto: "task"
                 resultado = await session.call_tool(
@@ -65,9 +73,9 @@ async def consultar_jefe_seguridad():
                 
                 print(f"✅ Jefe de Seguridad (via MCP) responde:\n{respuesta}\n")
                 
-                print("="*80)
-                print("✅ Consulta completada exitosamente")
-                print("="*80)
+                log.info("="*80)
+                log.info("✅ Consulta completada exitosamente")
+                log.info("="*80)
                 
     except Exception as e:
         print(f"\n❌ Error al conectar con servidor MCP: {e}")
@@ -76,5 +84,13 @@ async def consultar_jefe_seguridad():
         raise
 
 if __name__ == "__main__":
-    print("\n🚀 Iniciando cliente MCP del Oficial de Operaciones...\n")
-    asyncio.run(consultar_jefe_seguridad())
+    # Solo los banners van por el logger (MCP_LOG=WARNING los oculta); la pregunta,
+    # la respuesta y los errores se imprimen siempre con print
+    configurar_log("mcp.cliente", sys.stdout)
+    log.info("\n🚀 Iniciando cliente MCP del Oficial de Operaciones...\n")
+    # uvloop es opcional y solo POSIX; sin él, el loop estándar de asyncio
+    if importlib.util.find_spec("uvloop") is not None:
+        import uvloop
+        uvloop.run(consultar_jefe_seguridad())
+    else:
+        asyncio.run(consultar_jefe_seguridad())
@@ -1,202 +1,598 @@
 import asyncio
+import atexit
+import functools
+import hashlib
+import importlib.util
 import json
+import logging
 import os
+import pickle
+import re
 import sys
-import urllib.request
+from contextlib import AsyncExitStack, suppress
 from pathlib import Path
 from typing import Any
 
+import anyio
+import httpx
+import numpy as np
+import orjson
 from mcp import ClientSession, StdioServerParameters
-from mcp.client.stdio import stdio_client
-
-
-def _quitar_acentos_simple(s: str) -> str:
-    tabla = str.maketrans(
-        {
-            "Á": "A",
-            "É": "E",
-            "Í": "I",
-            "Ó": "O",
-            "Ú": "U",
-            "Ä": "A",
-            "Ë": "E",
-            "Ï": "I",
-            "Ö": "O",
-            "Ü": "U",
-            "À": "A",
-            "È": "E",
-            "Ì": "I",
-            "Ò": "O",
-            "Ù": "U",
-            "Ñ": "N",
-        }
-    )
-    return s.translate(tabla)
+from mcp.client.stdio import get_default_environment, stdio_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, Tool
+
+from env_utils import cargar_env
+
+log = logging.getLogger("capitan")
+
+
+_ACENTOS = {
+    "Á": "A",
+    "É": "E",
+    "Í": "I",
+    "Ó": "O",
+    "Ú": "U",
+    "Ä": "A",
+    "Ë": "E",
+    "Ï": "I",
+    "Ö": "O",
+    "Ü": "U",
+    "À": "A",
+    "È": "E",
+    "Ì": "I",
+    "Ò": "O",
+    "Ù": "U",
+    "Ñ": "N",
+}
+
+# Mayúsculas + quitar acentos en una única pasada de `str.translate`, precalculada al
+# importar: cubre las minúsculas ASCII y las formas minúsculas/mayúsculas de las
+# vocales acentuadas y la Ñ.
+_UPPER_ACCENT_TABLE = str.maketrans(
+    {
+        **{chr(c): chr(c - 32) for c in range(ord("a"), ord("z") + 1)},
+        **{k.lower(): v for k, v in _ACENTOS.items()},
+        **_ACENTOS,
+    }
+)
 
 
 def _normalizar(texto: str) -> str:
-    return _quitar_acentos_simple(texto.upper())
+    # Pasa a mayúsculas y quita acentos con `_UPPER_ACCENT_TABLE`; pensado para palabras
+    # clave en español, otros caracteres no ASCII se dejan igual.
+    return texto.translate(_UPPER_ACCENT_TABLE)
+
+
+# Palabra completa (TRABAJO no cuenta como BAJO) admitiendo plural: CRÍTICOS, ALTOS...
+_RISK_RE = re.compile(r"\b(CRITIC[OA]|ALTO|MEDIO|BAJO)S?\b")
+_RISK_MAP = {
+    "CRITICO": "CRÍTICO",
+    "CRITICA": "CRÍTICO",
+    "ALTO": "ALTO",
+    "MEDIO": "MEDIO",
+    "BAJO": "BAJO",
+}
+# Prioridad de cada nivel: si aparecen varios, gana el más grave.
+_RISK_ORDEN = {"CRÍTICO": 3, "ALTO": 2, "MEDIO": 1, "BAJO": 0}
+
+# Prefijos de líneas clave en mayúsculas, con y sin tilde (evita normalizar cada línea)
+_PREFIX_TUPLE = (
+    "RIESGO:",
+    "RECOMENDACION:",
+    "RECOMENDACIÓN:",
+    "JUSTIFICACION:",
+    "JUSTIFICACIÓN:",
+    "CONCLUSION:",
+    "CONCLUSIÓN:",
+    "ACCION:",
+    "ACCIÓN:",
+    "ACCION ",
+    "ACCIÓN ",
+)
+_PREFIX_MAX = max(len(p) for p in _PREFIX_TUPLE)
 
 
 def _nivel_riesgo(texto: str) -> str:
-    t = _normalizar(texto)
-    if "CRITICO" in t or "CRITICA" in t:
-        return "CRÍTICO"
-    if "ALTO" in t:
-        return "ALTO"
-    if "MEDIO" in t:
-        return "MEDIO"
-    if "BAJO" in t:
-        return "BAJO"
-    return "NO ESPECIFICADO"
+    # Una sola pasada con la alternancia compilada en lugar de 5 búsquedas `in`.
+    nivel = "NO ESPECIFICADO"
+    for m in _RISK_RE.finditer(_normalizar(texto)):
+        encontrado = _RISK_MAP[m.group(1)]
+        if encontrado == "CRÍTICO":
+            return encontrado
+        if nivel == "NO ESPECIFICADO" or _RISK_ORDEN[encontrado] > _RISK_ORDEN[nivel]:
+            nivel = encontrado
+    return nivel
+
+
+def _classify_batch(textos: list[str]) -> list[str]:
+    """Nivel de riesgo de cada respuesta, en el mismo orden.
+
+    Con 4 especialistas basta un bucle; este es el punto único a sustituir por una
+    versión vectorizada (una pasada sobre todos los textos) si crece su número.
+    """
+
+    return [_nivel_riesgo(t) for t in textos]
 
 
 def _extraer_claves(texto: str, max_lineas: int = 4) -> list[str]:
-    lineas = [l.strip() for l in texto.splitlines() if l.strip()]
-    if not lineas:
-        return []
-
-    claves = [
-        l
-        for l in lineas
-        if _normalizar(l).startswith(
-            (
-                "RIESGO:",
-                "RECOMENDACION:",
-                "JUSTIFICACION:",
-                "CONCLUSION:",
-                "ACCION:",
-                "ACCION ",
-            )
+    # Una sola pasada: se detiene en cuanto hay `max_lineas` líneas clave y, mientras
+    # tanto, guarda las primeras líneas no vacías por si no aparece ninguna.
+    claves: list[str] = []
+    primeras: list[str] = []
+    for raw in texto.splitlines():
+        l = raw.strip()
+        if not l:
+            continue
+        if l[:_PREFIX_MAX].upper().startswith(_PREFIX_TUPLE):
+            claves.append(l)
+            if len(claves) >= max_lineas:
+                return claves
+        elif len(primeras) < max_lineas:
+            primeras.append(l)
+    return claves or primeras
+
+
+def _numero_env(nombre: str, tipo: type, defecto: Any) -> Any:
+    valor = os.getenv(nombre)
+    if not valor:
+        return defecto
+    try:
+        return tipo(valor)
+    except ValueError:
+        log.warning(f"⚠️  {nombre}={valor!r} no es válido; se usa {defecto}")
+        return defecto
+
+
+class SemanticCache:
+    """Caché semántica de respuestas de especialistas (estilo GPTCache).
+
+    Por cada especialista guarda una matriz de embeddings normalizados y los textos
+    asociados. Una consulta es un acierto si la similitud coseno con la entrada más
+    cercana supera el umbral (`SEMANTIC_CACHE_THRESHOLD`, por defecto 0.92).
+
+    - Se persiste en un fichero pickle junto al script (una vez, al salir del proceso).
+    - El fichero guarda la configuración con la que se generó: deployment de embeddings,
+      deployment de chat y huella de task_16_puente_enterprise_server.py (instrucciones de
+      los especialistas). Si alguna cambia, las entradas guardadas se descartan al cargar.
+    - Como máximo `SEMANTIC_CACHE_MAX_ENTRIES` entradas por especialista (256 por defecto);
+      se descartan las más antiguas.
+    - `SEMANTIC_CACHE=0` la desactiva.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path, servidor: Path) -> None:
+        self.path = path
+        self.servidor = servidor
+        self._entradas: dict[str, tuple[np.ndarray, list[str]]] = {}
+        self._cargado = False
+        self._pendiente = False
+
+    @property
+    def habilitada(self) -> bool:
+        return os.getenv("SEMANTIC_CACHE", "1") != "0"
+
+    # Se leen en el primer uso (ya con el .env cargado) y no en cada consulta: un valor
+    # mal escrito avisa una sola vez y usa el por defecto en vez de romper el turno
+    @functools.cached_property
+    def threshold(self) -> float:
+        return _numero_env("SEMANTIC_CACHE_THRESHOLD", float, 0.92)
+
+    @functools.cached_property
+    def max_entradas(self) -> int:
+        return max(1, _numero_env("SEMANTIC_CACHE_MAX_ENTRIES", int, 256))
+
+    def _config(self) -> tuple[str, str, str]:
+        huella = hashlib.sha256(self.servidor.read_bytes()).hexdigest() if self.servidor.exists() else ""
+        return (_embedding_deployment(), os.getenv("AZURE_OPENAI_DEPLOYMENT") or "", huella)
+
+    def _cargar(self) -> None:
+        if self._cargado:
+            return
+        self._cargado = True
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open("rb") as f:
+                datos = pickle.load(f)
+        except Exception:  # noqa: BLE001 (workshop)
+            return
+        if isinstance(datos, dict) and datos.get("version") == self.VERSION and datos.get("config") == self._config():
+            self._entradas = datos.get("entradas") or {}
+
+    def buscar(self, tool_name: str, q: np.ndarray) -> str | None:
+        self._cargar()
+        entrada = self._entradas.get(tool_name)
+        if entrada is None:
+            return None
+        X, textos = entrada
+        if X.shape[1] != q.shape[0]:
+            return None
+        sims = X @ q
+        i = int(np.argmax(sims))
+        return textos[i] if sims[i] >= self.threshold else None
+
+    def guardar(self, tool_name: str, q: np.ndarray, texto: str) -> None:
+        self._cargar()
+        entrada = self._entradas.get(tool_name)
+        if entrada is None or entrada[0].shape[1] != q.shape[0]:
+            X, textos = q[np.newaxis, :], [texto]
+        else:
+            X, textos = np.vstack([entrada[0], q]), entrada[1] + [texto]
+        n = self.max_entradas
+        self._entradas[tool_name] = (X[-n:], textos[-n:])
+
+        if not self._pendiente:
+            self._pendiente = True
+            atexit.register(self.persistir)
+
+    def persistir(self) -> None:
+        if not self._pendiente:
+            return
+        self._pendiente = False
+        datos = {"version": self.VERSION, "config": self._config(), "entradas": self._entradas}
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(datos, f)
+        tmp.replace(self.path)
+
+
+def _embedding_deployment() -> str:
+    return os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT") or "text-embedding-3-small"
+
+
+_SCRIPT_DIR = Path(__file__).resolve().parent
+_cache_semantica = SemanticCache(
+    path=_SCRIPT_DIR / ".semantic_cache.pkl",
+    servidor=_SCRIPT_DIR / "task_16_puente_enterprise_server.py",
+)
+
+
+_embeddings_no_disponibles = False
+
+
+async def _embedding_task(task: str) -> np.ndarray | None:
+    """Embedding normalizado de `task` (o None si no hay configuración o falla la llamada).
+
+    Todos los especialistas reciben el mismo `task`, así que basta con una sola
+    petición de embeddings por consulta. Si la petición falla (p. ej. el deployment de
+    embeddings no existe) se avisa una vez y no se vuelve a intentar en este proceso.
+    """
+
+    global _embeddings_no_disponibles
+
+    base_url = os.getenv("AZURE_OPENAI_ENDPOINT")
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    if _embeddings_no_disponibles or not _cache_semantica.habilitada or not base_url or not api_key:
+        return None
+
+    try:
+        datos = await _azure_embeddings(
+            base_url=base_url,
+            api_key=api_key,
+            deployment=_embedding_deployment(),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION") or "2024-02-15-preview",
+            inputs=[task],
         )
-    ]
-    return (claves[:max_lineas] if claves else lineas[:max_lineas])
+    except Exception as e:  # noqa: BLE001 (workshop)
+        _embeddings_no_disponibles = True
+        log.warning(
+            f"⚠️  Caché semántica desactivada: embeddings no disponibles ({_embedding_deployment()}): {e}. "
+            "Configura AZURE_OPENAI_EMBEDDING_DEPLOYMENT o SEMANTIC_CACHE=0."
+        )
+        return None
 
+    q = np.asarray(datos[0], dtype=np.float32)
+    norma = float(np.linalg.norm(q))
+    return q / norma if norma else None
 
-async def consultar_puente_enterprise_mcp(task: str, especialistas: list[str] | None = None) -> str:
-    """Consulta a especialistas (agentes) del Puente del Enterprise vía MCP.
 
-    Devuelve un JSON (string) con:
-    - herramientas_disponibles
-    - respuestas: [{especialista, riesgo_detectado, claves, respuesta}]
-    - errores: [{especialista, error}]
+# Nombres de las herramientas que expone task_16_puente_enterprise_server.py
+# (debe mantenerse alineado con los `name` de `especialistas_puente`).
+_ESPECIALISTAS_CONOCIDOS = (
+    "Oficial de Ciencias - Enterprise",
+    "Jefe de Ingeniería - Enterprise",
+    "Jefe de Seguridad - Enterprise",
+    "Oficial Médico - Enterprise",
+)
 
-    Nota: esta herramienta *inicia* el servidor MCP mediante stdio (subproceso) y lo consulta.
-    """
+# Herramienta del servidor que consulta a todos los especialistas en una sola petición
+_HERRAMIENTA_TODOS = "consultar_todos"
 
-    script_dir = Path(__file__).resolve().parent
-    venv_python = script_dir / ".MAFvenv" / "Scripts" / "python.exe"
-    server_python = str(venv_python) if venv_python.exists() else sys.executable
 
-    server_params = StdioServerParameters(
-        command=server_python,
-        args=["task_16_puente_enterprise_server.py"],
-        env=None,
-    )
+# Variables de control del servidor que se reenvían al subproceso: stdio_client solo
+# hereda una lista mínima del entorno (HOME, PATH...), así que sin esto
+# `MCP_NOCACHE=1 python task_16_capitan_enterprise_agent.py` no llegaría al servidor.
+_ENV_REENVIADAS = ("MCP_NOCACHE", "MCP_WARMUP", "MCP_LOG")
 
-    respuestas: list[dict[str, Any]] = []
-    errores: list[dict[str, str]] = []
 
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
+def _entorno_servidor() -> dict[str, str]:
+    return {**get_default_environment(), **{k: os.environ[k] for k in _ENV_REENVIADAS if k in os.environ}}
 
-            tools = await session.list_tools()
-            herramientas_disponibles = [t.name for t in tools.tools]
 
-            if especialistas:
-                # Filtrar a las solicitadas (sin fallar si hay alguna que no exista)
-                solicitadas = [e for e in especialistas if e in herramientas_disponibles]
-                a_consultar = solicitadas if solicitadas else herramientas_disponibles
-            else:
-                a_consultar = herramientas_disponibles
+class _SessionHolder:
+    """Mantiene vivo un único subproceso del servidor MCP y su `ClientSession`.
 
-            for tool_name in a_consultar:
+    El primer `get()` arranca `task_16_puente_enterprise_server.py` por stdio e inicializa
+    la sesión; las llamadas siguientes reutilizan la misma sesión y evitan el arranque en
+    frío (intérprete, imports y construcción de los agentes) en cada turno del orquestador.
+
+    `cerrar()` debe esperarse desde la misma tarea que abrió la sesión (los context
+    managers de stdio usan task groups de anyio), por eso se llama en el `finally` de `main()`.
+    Si el servidor muere, `consultar_puente_enterprise_mcp` llama a `cerrar()` y reabre la
+    sesión (y con ella la caché de `list_tools`) una vez.
+    """
+
+    _pila: AsyncExitStack | None = None
+    _session: ClientSession | None = None
+    _lock: asyncio.Lock | None = None
+    _tools_cache: list[Tool] | None = None
+
+    @classmethod
+    async def get(cls) -> ClientSession:
+        if cls._session is not None:
+            return cls._session
+
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+
+        async with cls._lock:
+            if cls._session is None:
+                script_dir = Path(__file__).resolve().parent
+                venv_python = script_dir / ".MAFvenv" / "Scripts" / "python.exe"
+                server_python = str(venv_python) if venv_python.exists() else sys.executable
+
+                server_params = StdioServerParameters(
+                    command=server_python,
+                    args=["task_16_puente_enterprise_server.py"],
+                    env=_entorno_servidor(),
+                )
+
+                pila = AsyncExitStack()
                 try:
-                    resultado = await session.call_tool(
-                        name=tool_name,
-                        arguments={"task": task},
-                    )
-
-                    if hasattr(resultado, "content") and resultado.content:
-                        content_items = (
-                            resultado.content if isinstance(resultado.content, list) else [resultado.content]
-                        )
-                        partes: list[str] = []
-                        for item in content_items:
-                            partes.append(str(getattr(item, "text", item)))
-                        texto = "\n".join([p for p in partes if p]).strip()
-                    else:
-                        texto = str(resultado)
-
-                    respuestas.append(
-                        {
-                            "especialista": tool_name,
-                            "riesgo_detectado": _nivel_riesgo(texto),
-                            "claves": _extraer_claves(texto, max_lineas=4),
-                            "respuesta": texto,
-                        }
-                    )
-                except Exception as e:  # noqa: BLE001 (workshop)
-                    errores.append({"especialista": tool_name, "error": str(e)})
+                    read, write = await pila.enter_async_context(stdio_client(server_params))
+                    session = await pila.enter_async_context(ClientSession(read, write))
+                    await session.initialize()
+                except BaseException:
+                    await pila.aclose()
+                    raise
 
-    payload = {
-        "herramientas_disponibles": herramientas_disponibles,
-        "respuestas": respuestas,
-        "errores": errores,
-    }
+                cls._pila = pila
+                cls._session = session
+
+        return cls._session
+
+    @classmethod
+    async def list_tools(cls) -> list[Tool]:
+        """Herramientas del servidor; son estáticas mientras viva la sesión, así que se memorizan."""
+        session = await cls.get()
+        if cls._tools_cache is None:
+            cls._tools_cache = (await session.list_tools()).tools
+        return cls._tools_cache
+
+    @classmethod
+    async def cerrar(cls) -> None:
+        pila, cls._pila, cls._session, cls._tools_cache = cls._pila, None, None, None
+        if pila is not None:
+            await pila.aclose()
 
-    return json.dumps(payload, ensure_ascii=False, indent=2)
 
+def _es_error_de_transporte(e: BaseException) -> bool:
+    """True si el error indica que la conexión stdio con el servidor MCP se ha perdido."""
+
+    if isinstance(e, (anyio.ClosedResourceError, anyio.BrokenResourceError, anyio.EndOfStream)):
+        return True
+    return isinstance(e, McpError) and e.error.code == CONNECTION_CLOSED
+
+
+def _texto_resultado(resultado: Any) -> str:
+    """Texto plano de un resultado de `call_tool` (une los `TextContent`)."""
+
+    if hasattr(resultado, "content") and resultado.content:
+        content_items = resultado.content if isinstance(resultado.content, list) else [resultado.content]
+        partes: list[str] = []
+        for item in content_items:
+            partes.append(str(getattr(item, "text", item)))
+        return "\n".join([p for p in partes if p]).strip()
+    return str(resultado)
+
+
+async def consultar_puente_enterprise_mcp(task: str, especialistas: list[str] | None = None) -> str:
+    """Consulta a especialistas (agentes) del Puente del Enterprise vía MCP.
 
-def _cargar_env() -> None:
-    """Carga variables desde .env (sin depender de python-dotenv).
+    Devuelve un JSON (string) con:
+    - herramientas_disponibles
+    - respuestas: [{especialista, riesgo_detectado, claves, respuesta}]
+    - errores: [{especialista, error}]
 
-    - No sobreescribe variables ya definidas en el entorno.
-    - Soporta valores entre comillas simples o dobles.
+    Nota: la primera llamada *inicia* el servidor MCP mediante stdio (subproceso); las
+    siguientes reutilizan la misma sesión (ver `_SessionHolder`).
     """
 
-    env_path = Path(__file__).resolve().parent / ".env"
-    if not env_path.exists():
-        return
+    # El embedding va en paralelo con la apertura de la sesión. La sesión se abre en esta
+    # tarea (no dentro de gather) porque sus task groups de anyio deben cerrarse en la misma.
+    tarea_embedding = asyncio.create_task(_embedding_task(task))
+    try:
+        session = await _SessionHolder.get()
+    except BaseException:
+        tarea_embedding.cancel()
+        raise
+    q = await tarea_embedding
+
+    async def _fase_mcp(
+        session: ClientSession,
+    ) -> tuple[list[str], list[str], dict[str, str], dict[str, str], dict[str, str]]:
+        if especialistas and all(e in _ESPECIALISTAS_CONOCIDOS for e in especialistas):
+            # Todos los solicitados son especialistas conocidos: no hace falta list_tools
+            nombres = list(_ESPECIALISTAS_CONOCIDOS)
+        else:
+            nombres = [t.name for t in await _SessionHolder.list_tools()]
+
+        consultar_todos_disponible = _HERRAMIENTA_TODOS in nombres
+        herramientas_disponibles = [n for n in nombres if n != _HERRAMIENTA_TODOS]
+
+        if especialistas:
+            # Filtrar a las solicitadas (sin fallar si hay alguna que no exista)
+            solicitadas = [e for e in especialistas if e in herramientas_disponibles]
+            a_consultar = solicitadas if solicitadas else herramientas_disponibles
+        else:
+            a_consultar = herramientas_disponibles
+
+        cacheados: dict[str, str] = {}
+        if q is not None:
+            for tool_name in a_consultar:
+                cacheado = _cache_semantica.buscar(tool_name, q)
+                if cacheado is not None:
+                    cacheados[tool_name] = cacheado
+        pendientes = [t for t in a_consultar if t not in cacheados]
 
-    for raw_line in env_path.read_text(encoding="utf-8").splitlines():
-        line = raw_line.strip()
-        if not line or line.startswith("#") or "=" not in line:
-            continue
+        textos: dict[str, str] = {}
+        fallos: dict[str, str] = {}
 
-        key, value = line.split("=", 1)
-        key = key.strip()
-        value = value.strip().strip("\ufeff")
+        async def _call_one(tool_name: str) -> None:
+            """Consulta a un especialista y anota su texto en `textos` o el error en `fallos`."""
+            try:
+                resultado = await session.call_tool(
+                    name=tool_name,
+                    arguments={"task": task},
+                )
+                if resultado.isError:
+                    # El servidor captura la excepción del handler y la devuelve como contenido
+                    fallos[tool_name] = _texto_resultado(resultado) or "Error en la herramienta"
+                else:
+                    textos[tool_name] = _texto_resultado(resultado)
+            except Exception as e:  # noqa: BLE001 (workshop)
+                if _es_error_de_transporte(e):
+                    raise
+                fallos[tool_name] = str(e)
+
+        if especialistas is None and consultar_todos_disponible and len(pendientes) == len(herramientas_disponibles) > 1:
+            # Sin caché y consultando a todos: una sola petición MCP; el servidor
+            # ejecuta a los especialistas en paralelo y devuelve un array JSON.
+            try:
+                resultado = await session.call_tool(name=_HERRAMIENTA_TODOS, arguments={"task": task})
+                if resultado.isError:
+                    raise RuntimeError(_texto_resultado(resultado) or "Error en la herramienta")
+                for item in orjson.loads(_texto_resultado(resultado)):
+                    if "error" in item:
+                        fallos[item["especialista"]] = str(item["error"])
+                    else:
+                        textos[item["especialista"]] = str(item.get("respuesta") or "").strip()
+            except Exception as e:  # noqa: BLE001 (workshop)
+                if _es_error_de_transporte(e):
+                    raise
+                for tool_name in pendientes:
+                    fallos.setdefault(tool_name, str(e))
+        else:
+            # ClientSession multiplexa peticiones concurrentes por id sobre el mismo stdio,
+            # y el servidor lowlevel atiende cada petición en su propia tarea: los
+            # especialistas se consultan en paralelo y la latencia es la del más lento.
+            for r in await asyncio.gather(*[_call_one(t) for t in pendientes], return_exceptions=True):
+                if isinstance(r, BaseException):
+                    raise r
+
+        return herramientas_disponibles, a_consultar, cacheados, textos, fallos
+
+    # Si el subproceso del servidor murió, la sesión guardada falla con un error de
+    # transporte: se cierra, se vuelve a abrir y se reintenta una sola vez.
+    try:
+        herramientas_disponibles, a_consultar, cacheados, textos, fallos = await _fase_mcp(session)
+    except Exception as e:
+        if not _es_error_de_transporte(e):
+            raise
+        log.warning(f"⚠️  Sesión MCP perdida ({e!r}); reconectando con el Puente del Enterprise")
+        with suppress(Exception):
+            # El subproceso ya no responde: cerrar puede volver a fallar, da igual
+            await _SessionHolder.cerrar()
+        session = await _SessionHolder.get()
+        herramientas_disponibles, a_consultar, cacheados, textos, fallos = await _fase_mcp(session)
+
+    obtenidas = [(t, cacheados.get(t, textos.get(t))) for t in a_consultar]
+    contestadas = [(t, texto) for t, texto in obtenidas if texto is not None]
+    niveles = _classify_batch([texto for _, texto in contestadas])
+
+    respuestas: list[dict[str, Any]] = [
+        {
+            "especialista": tool_name,
+            "riesgo_detectado": nivel,
+            "claves": _extraer_claves(texto, max_lineas=4),
+            "respuesta": texto,
+        }
+        for (tool_name, texto), nivel in zip(contestadas, niveles)
+    ]
+    errores: list[dict[str, str]] = [
+        {"especialista": tool_name, "error": fallos.get(tool_name, "Sin respuesta")}
+        for tool_name, texto in obtenidas
+        if texto is None
+    ]
 
-        if not key or key in os.environ:
-            continue
+    # Solo se cachean respuestas reales; los errores (isError, excepciones) van a `fallos`
+    if q is not None:
+        for tool_name, texto in textos.items():
+            _cache_semantica.guardar(tool_name, q, texto)
 
-        if (value.startswith('"') and value.endswith('"')) or (value.startswith("'") and value.endswith("'")):
-            value = value[1:-1]
+    payload = {
+        "herramientas_disponibles": herramientas_disponibles,
+        "respuestas": respuestas,
+        "errores": errores,
+    }
 
-        os.environ[key] = value
+    return json.dumps(payload, ensure_ascii=False, indent=2)
 
 
-def _azure_openai_url(base_url: str, deployment: str, api_version: str) -> tuple[str, bool]:
+# Mismos argumentos en cada llamada: se calcula una vez por (config, operación)
+@functools.lru_cache(maxsize=4)
+def _azure_openai_url(
+        base_url: str, deployment: str, api_version: str, operacion: str = "chat/completions"
+) -> tuple[str, bool]:
         """Devuelve (url, is_openai_v1).
 
         - Si el endpoint es OpenAI-compatible (termina en /openai/v1 o /openai/v1/):
-            - URL: <base>/chat/completions
+            - URL: <base>/<operacion>
             - Se debe enviar el campo 'model' en el payload.
 
         - Si es Azure "deployments":
-            - URL: <base>/openai/deployments/<deployment>/chat/completions?api-version=...
+            - URL: <base>/openai/deployments/<deployment>/<operacion>?api-version=...
             - No es necesario enviar 'model'.
+
+        `operacion` es "chat/completions" (por defecto) o "embeddings".
         """
 
         base = base_url.rstrip("/")
         if base.endswith("/openai/v1"):
-                return f"{base}/chat/completions", True
-        return f"{base}/openai/deployments/{deployment}/chat/completions?api-version={api_version}", False
+                return f"{base}/{operacion}", True
+        return f"{base}/openai/deployments/{deployment}/{operacion}?api-version={api_version}", False
+
+
+_HTTP: httpx.AsyncClient | None = None
+
 
+def _client() -> httpx.AsyncClient:
+    """Cliente HTTP asíncrono compartido (keep-alive; HTTP/2 si está instalado `h2`).
 
-def _azure_chat_completions(
+    Reutiliza conexiones TLS entre peticiones y no bloquea el event loop mientras se
+    espera la respuesta del modelo.
+    """
+
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(max_keepalive_connections=8),
+            timeout=120,
+        )
+    return _HTTP
+
+
+async def _cerrar_http() -> None:
+    global _HTTP
+    cliente, _HTTP = _HTTP, None
+    if cliente is not None:
+        await cliente.aclose()
+
+
+async def _azure_chat_completions(
     *,
     base_url: str,
     api_key: str,
@@ -206,9 +602,25 @@ def _azure_chat_completions(
     tools: list[dict[str, Any]] | None = None,
     tool_choice: dict[str, Any] | str | None = None,
     temperature: float = 0.2,
+    cache_control: bool = False,
 ) -> dict[str, Any]:
+    """Llamada a chat/completions.
+
+    Con `cache_control=True` el mensaje system se envía como bloque de texto con
+    `"cache_control": {"type": "ephemeral"}`, para gateways compatibles con Anthropic
+    que requieren marcar explícitamente el prefijo cacheable. Azure OpenAI no lo necesita.
+    """
+
     url, is_openai_v1 = _azure_openai_url(base_url, deployment, api_version)
 
+    if cache_control:
+        messages = [
+            {**m, "content": [{"type": "text", "text": m["content"], "cache_control": {"type": "ephemeral"}}]}
+            if m.get("role") == "system" and isinstance(m.get("content"), str)
+            else m
+            for m in messages
+        ]
+
     payload: dict[str, Any] = {
         "messages": messages,
         "temperature": temperature,
@@ -222,20 +634,46 @@ def _azure_chat_completions(
     if tool_choice is not None:
         payload["tool_choice"] = tool_choice
 
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-    req = urllib.request.Request(
-        url=url,
-        data=body,
-        method="POST",
+    body = orjson.dumps(payload)
+    resp = await _client().post(
+        url,
+        content=body,
         headers={
             "Content-Type": "application/json",
             "api-key": api_key,
         },
     )
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
 
-    with urllib.request.urlopen(req, timeout=120) as resp:
-        raw = resp.read().decode("utf-8")
-        return json.loads(raw)
+
+async def _azure_embeddings(
+    *,
+    base_url: str,
+    api_key: str,
+    deployment: str,
+    api_version: str,
+    inputs: list[str],
+) -> list[list[float]]:
+    url, is_openai_v1 = _azure_openai_url(base_url, deployment, api_version, operacion="embeddings")
+
+    payload: dict[str, Any] = {"input": inputs}
+    if is_openai_v1:
+        payload["model"] = deployment
+
+    body = orjson.dumps(payload)
+    resp = await _client().post(
+        url,
+        content=body,
+        headers={
+            "Content-Type": "application/json",
+            "api-key": api_key,
+        },
+        timeout=60,
+    )
+    resp.raise_for_status()
+    datos = orjson.loads(resp.content).get("data") or []
+    return [d["embedding"] for d in sorted(datos, key=lambda d: d.get("index", 0))]
 
 
 def _tool_schema_consultar_puente() -> dict[str, Any]:
@@ -260,21 +698,17 @@ def _tool_schema_consultar_puente() -> dict[str, Any]:
     }
 
 
-async def _run_capitan(escenario: str) -> str:
-    _cargar_env()
+# Se construye una sola vez; `_azure_chat_completions` solo lo serializa, no lo modifica.
+_TOOL_SCHEMA_LIST = [_tool_schema_consultar_puente()]
 
-    base_url = os.getenv("AZURE_OPENAI_ENDPOINT")
-    api_key = os.getenv("AZURE_OPENAI_API_KEY")
-    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-    api_version = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-02-15-preview"
-
-    if not base_url or not api_key or not deployment:
-        raise RuntimeError(
-            "Faltan variables de entorno. Configura AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY y AZURE_OPENAI_DEPLOYMENT. "
-            "Opcional: AZURE_OPENAI_API_VERSION."
-        )
-
-    system_prompt = """Eres el Capitán del Enterprise-D.
+# Prompt caching (Azure/OpenAI lo aplica automáticamente sobre prefijos idénticos):
+# el prefijo cacheable es [tools = _TOOL_SCHEMA_LIST] + [mensaje system = _SYSTEM_PROMPT].
+# Ambos deben mantenerse byte a byte inmutables entre llamadas; todo lo variable
+# (escenario, tool_calls, resultados MCP) va siempre después, al final de `messages`.
+# PROMPT_CACHE_CONTROL=1 (desactivado por defecto) marca además el mensaje system con
+# `cache_control: ephemeral` al estilo Anthropic. Úsalo solo si AZURE_OPENAI_ENDPOINT apunta
+# a un gateway compatible con Anthropic; contra Azure OpenAI no hace falta y no se recomienda.
+_SYSTEM_PROMPT = """Eres el Capitán del Enterprise-D.
 Tu misión es tomar una decisión final tras consultar a especialistas (agentes) vía MCP.
 
 REGLAS OBLIGATORIAS:
@@ -295,10 +729,56 @@ MITIGACIONES / SIGUIENTES PASOS:
 - <lista de 3-6 acciones>
 """
 
-    tools = [_tool_schema_consultar_puente()]
+
+async def _consultar_una_vez(
+    memo: dict[tuple[str, tuple[str, ...]], asyncio.Future[str]],
+    task: str,
+    especialistas: list[str] | None = None,
+) -> str:
+    """`consultar_puente_enterprise_mcp` con memo por turno (single-flight).
+
+    Si el modelo repite la misma tool_call (o el mismo escenario) dentro de un turno,
+    se reutiliza el resultado; las peticiones idénticas en curso esperan al mismo Future.
+    Los errores no se memorizan.
+    """
+
+    clave = (task, tuple(especialistas or ()))
+    fut = memo.get(clave)
+    if fut is not None:
+        return await fut
+
+    fut = asyncio.get_running_loop().create_future()
+    memo[clave] = fut
+    try:
+        fut.set_result(await consultar_puente_enterprise_mcp(task=task, especialistas=especialistas))
+    except Exception as e:
+        memo.pop(clave, None)
+        fut.set_exception(e)
+        fut.exception()  # marcada como recuperada aunque no haya nadie más esperando
+        raise
+    return fut.result()
+
+
+async def _run_capitan(escenario: str) -> str:
+    cargar_env()
+
+    base_url = os.getenv("AZURE_OPENAI_ENDPOINT")
+    api_key = os.getenv("AZURE_OPENAI_API_KEY")
+    deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    api_version = os.getenv("AZURE_OPENAI_API_VERSION") or "2024-02-15-preview"
+
+    if not base_url or not api_key or not deployment:
+        raise RuntimeError(
+            "Faltan variables de entorno. Configura AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY y AZURE_OPENAI_DEPLOYMENT. "
+            "Opcional: AZURE_OPENAI_API_VERSION."
+        )
+
+    tools = _TOOL_SCHEMA_LIST
+    cache_control = os.getenv("PROMPT_CACHE_CONTROL") == "1"
+    memo: dict[tuple[str, tuple[str, ...]], asyncio.Future[str]] = {}
 
     messages: list[dict[str, Any]] = [
-        {"role": "system", "content": system_prompt},
+        {"role": "system", "content": _SYSTEM_PROMPT},
         {
             "role": "user",
             "content": (
@@ -308,7 +788,7 @@ MITIGACIONES / SIGUIENTES PASOS:
     ]
 
     # 1) Primer turno: el modelo debería pedir la herramienta
-    resp1 = _azure_chat_completions(
+    resp1 = await _azure_chat_completions(
         base_url=base_url,
         api_key=api_key,
         deployment=deployment,
@@ -317,6 +797,7 @@ MITIGACIONES / SIGUIENTES PASOS:
         tools=tools,
         tool_choice="auto",
         temperature=0.2,
+        cache_control=cache_control,
     )
 
     msg1 = (resp1.get("choices") or [{}])[0].get("message") or {}
@@ -324,7 +805,7 @@ MITIGACIONES / SIGUIENTES PASOS:
 
     if not tool_calls:
         # Fallback: si el modelo no llama herramienta, forzamos una llamada y pedimos síntesis.
-        tool_result = await consultar_puente_enterprise_mcp(task=escenario)
+        tool_result = await _consultar_una_vez(memo, task=escenario)
         messages.append({"role": "assistant", "content": msg1.get("content") or ""})
         messages.append({"role": "tool", "tool_call_id": "forced", "content": tool_result})
     else:
@@ -358,7 +839,8 @@ MITIGACIONES / SIGUIENTES PASOS:
                 else:
                     especialistas_list = [str(especialistas_arg)]
 
-                result = await consultar_puente_enterprise_mcp(
+                result = await _consultar_una_vez(
+                    memo,
                     task=str(args.get("task") or escenario),
                     especialistas=especialistas_list,
                 )
@@ -372,7 +854,7 @@ MITIGACIONES / SIGUIENTES PASOS:
             )
 
     # 2) Segundo turno: respuesta final
-    resp2 = _azure_chat_completions(
+    resp2 = await _azure_chat_completions(
         base_url=base_url,
         api_key=api_key,
         deployment=deployment,
@@ -380,6 +862,7 @@ MITIGACIONES / SIGUIENTES PASOS:
         messages=messages,
         tools=tools,
         temperature=0.2,
+        cache_control=cache_control,
     )
 
     msg2 = (resp2.get("choices") or [{}])[0].get("message") or {}
@@ -400,7 +883,11 @@ Necesito evaluación inmediata de:
 3. ¿Cuál es el riesgo para la tripulación?
 4. ¿Hay impacto médico potencial?"""
     print(escenario)
-    texto = await _run_capitan(escenario)
+    try:
+        texto = await _run_capitan(escenario)
+    finally:
+        await _SessionHolder.cerrar()
+        await _cerrar_http()
 
     print("\n" + "=" * 80)
     print("✅ DECISIÓN FINAL (AGENTE CAPITÁN)")
@@ -409,4 +896,10 @@ Necesito evaluación inmediata de:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop.run() en Linux/macOS si está instalado (install() está obsoleto);
+    # en Windows no existe y se usa asyncio.run con el loop por defecto
+    if importlib.util.find_spec("uvloop") is not None:
+        import uvloop
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -1,30 +1,42 @@
 import os
 import sys
+import importlib.util
 import os
+import asyncio
+from collections import OrderedDict
 from typing import Any
 import anyio
-from dotenv import load_dotenv
+import orjson
 from mcp.server.stdio import stdio_server
 from mcp.server.lowlevel import Server
 from mcp import types
 from agent_framework import ChatAgent
 from agent_framework.openai import OpenAIChatClient
+from env_utils import cargar_env, configurar_log
 
 # Cargar configuración
-load_dotenv()
+cargar_env()
+
+# Banners del puente por stderr (stdout lo ocupa el protocolo); nivel vía MCP_LOG
+log = configurar_log("mcp.startup", sys.stderr)
 
 base_url = os.getenv("AZURE_OPENAI_ENDPOINT")
 api_key = os.getenv("AZURE_OPENAI_API_KEY")
 model_id = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 
+# Un único cliente para todos los especialistas: comparten el pool de conexiones
+# HTTP (y el handshake TLS) en lugar de abrir uno por agente. El cliente no guarda
+# estado de conversación; cada ChatAgent aporta sus propias instrucciones.
+cliente_compartido = OpenAIChatClient(
+    base_url=base_url,
+    api_key=api_key,
+    model_id=model_id
+)
+
 # Crear especialistas del Puente del Enterprise
 especialistas_puente = {
     "Oficial de Ciencias": ChatAgent(
-        chat_client=OpenAIChatClient(
-            base_url=base_url,
-            api_key=api_key,
-            model_id=model_id
-        ),
+        chat_client=cliente_compartido,
         name="Oficial de Ciencias - Enterprise",
         instructions="""Eres el Oficial de Ciencias del Enterprise-D. Tu responsabilidad es:
 - Analizar datos de sensores
@@ -36,11 +48,7 @@ especialistas_puente = {
 Responde en español como oficial Starfleet con precisión científica."""
     ),
     "Jefe de Ingeniería": ChatAgent(
-        chat_client=OpenAIChatClient(
-            base_url=base_url,
-            api_key=api_key,
-            model_id=model_id
-        ),
+        chat_client=cliente_compartido,
         name="Jefe de Ingeniería - Enterprise",
         instructions="""Eres el Jefe de Ingeniería del Enterprise. Tu responsabilidad es:
 - Evaluar capacidad del motor warp
@@ -52,11 +60,7 @@ Responde en español como oficial Starfleet con precisión científica."""
 Responde en español como oficial Starfleet con autoridad técnica."""
     ),
     "Jefe de Seguridad": ChatAgent(
-        chat_client=OpenAIChatClient(
-            base_url=base_url,
-            api_key=api_key,
-            model_id=model_id
-        ),
+        chat_client=cliente_compartido,
         name="Jefe de Seguridad - Enterprise",
         instructions="""Eres el Jefe de Seguridad del Enterprise. Tu responsabilidad es:
 - Evaluar riesgos tácticos
@@ -68,11 +72,7 @@ Responde en español como oficial Starfleet con autoridad técnica."""
 Responde en español como oficial Starfleet con precisión táctica."""
     ),
     "Oficial Médico": ChatAgent(
-        chat_client=OpenAIChatClient(
-            base_url=base_url,
-            api_key=api_key,
-            model_id=model_id
-        ),
+        chat_client=cliente_compartido,
         name="Oficial Médico - Enterprise",
         instructions="""Eres el Oficial Médico del Enterprise. Tu responsabilidad es:
 - Evaluar impacto en la salud de la tripulación
@@ -91,40 +91,125 @@ servidor_principal = Server(
     instructions="Servidor MCP que expone especialistas del Enterprise como herramientas."
 )
 
-# Mapeo por nombre de herramienta
-agentes_por_nombre = {agente.name: agente for agente in especialistas_puente.values()}
+# Agentes en orden fijo (para iterar) y mapeo por nombre de herramienta (para despachar)
+agentes = tuple(especialistas_puente.values())
+agentes_por_nombre = {agente.name: agente for agente in agentes}
+
+# Herramienta adicional que consulta a todos los especialistas en una sola petición MCP.
+# Se anuncia en list_tools junto a ellos, marcada con "[LOTE]" en la descripción.
+HERRAMIENTA_TODOS = "consultar_todos"
+
+def _input_schema(descripcion: str) -> dict[str, Any]:
+    return {
+        "type": "object",
+        "properties": {
+            "task": {
+                "type": "string",
+                "description": descripcion,
+            }
+        },
+        "required": ["task"],
+    }
+
+# Lista de herramientas estática: se construye una sola vez al importar
+herramientas = tuple(
+    types.Tool(
+        name=agente.name, # type: ignore
+        description=f"Especialista del Enterprise: {agente.name}",
+        inputSchema=_input_schema(f"Task for {agente.name}"),
+    )
+    for agente in agentes
+) + (
+    types.Tool(
+        name=HERRAMIENTA_TODOS,
+        description="[LOTE] No es un especialista: consulta en paralelo a todos los especialistas "
+        "del Enterprise y devuelve un array JSON [{especialista, respuesta | error}]",
+        inputSchema=_input_schema("Task for all Enterprise specialists"),
+    ),
+)
 
 @servidor_principal.list_tools()
 async def listar_herramientas() -> list[types.Tool]:
-    tools: list[types.Tool] = []
-    for agente in especialistas_puente.values():
-        tools.append(
-            types.Tool(
-                name=agente.name, # type: ignore
-                description=f"Especialista del Enterprise: {agente.name}",
-                inputSchema={
-                    "type": "object",
-                    "properties": {
-                        "task": {
-                            "type": "string",
-                            "description": f"Task for {agente.name}",
-                        }
-                    },
-                    "required": ["task"],
-                },
-            )
-        )
-    return tools
+    return list(herramientas)
+
+# Caché exacta (tool_name, task) -> respuesta, acotada a las últimas N entradas.
+# Repetir el mismo escenario no vuelve a llamar al modelo; MCP_NOCACHE=1 la desactiva.
+# Vive en memoria del proceso servidor: dura lo que dure la sesión MCP del cliente
+# (el Capitán cierra el subproceso al terminar main(), así que no persiste entre ejecuciones).
+CACHE_EXACTA_MAX = 512
+cache_exacta: OrderedDict[tuple[str, str], str] = OrderedDict()
+
+# Se marca al terminar el precalentamiento (ver precalentar_cliente); None si está desactivado
+precalentado: anyio.Event | None = None
+
+async def ejecutar_agente(agente: ChatAgent, task: str) -> str:
+    clave = (agente.name, task) # type: ignore
+    usar_cache = os.getenv("MCP_NOCACHE") != "1"
+    if usar_cache and clave in cache_exacta:
+        cache_exacta.move_to_end(clave)
+        return cache_exacta[clave]
+
+    # La primera consulta reutiliza la conexión que está abriendo el precalentamiento
+    # en vez de abrir otra en paralelo
+    if precalentado is not None:
+        await precalentado.wait()
+
+    respuesta = str(await agente.run(task))
+
+    if usar_cache:
+        cache_exacta[clave] = respuesta
+        if len(cache_exacta) > CACHE_EXACTA_MAX:
+            cache_exacta.popitem(last=False)
+    return respuesta
+
+async def consultar_todos(task: str) -> list[dict[str, str]]:
+    """Ejecuta a todos los especialistas a la vez; un fallo no cancela al resto."""
+    resultados = await asyncio.gather(*(ejecutar_agente(a, task) for a in agentes), return_exceptions=True)
+    salida: list[dict[str, str]] = []
+    for agente, resultado in zip(agentes, resultados):
+        if isinstance(resultado, BaseException):
+            salida.append({"especialista": agente.name, "error": str(resultado)}) # type: ignore
+        else:
+            salida.append({"especialista": agente.name, "respuesta": str(resultado)}) # type: ignore
+    return salida
 
 @servidor_principal.call_tool()
 async def ejecutar_herramienta(tool_name: str, arguments: dict[str, Any]) -> list[types.TextContent]:
+    if tool_name == HERRAMIENTA_TODOS:
+        task = (arguments or {}).get("task", "")
+        salida = await consultar_todos(task)
+        return [types.TextContent(type="text", text=orjson.dumps(salida).decode("utf-8"))]
+
     agente = agentes_por_nombre.get(tool_name)
     if not agente:
         return [types.TextContent(type="text", text=f"Herramienta desconocida: {tool_name}")]
 
     task = (arguments or {}).get("task", "")
-    respuesta = await agente.run(task)
-    return [types.TextContent(type="text", text=str(respuesta))]
+    respuesta = await ejecutar_agente(agente, task)
+    return [types.TextContent(type="text", text=respuesta)]
+
+async def precalentar_cliente():
+    """Abre la conexión con el modelo (TLS, pool HTTP) mientras el servidor ya atiende.
+
+    Usa un GET de /models, que no genera tokens ni se factura como una completion; lo que
+    interesa es el handshake, así que incluso una respuesta de error deja la conexión lista.
+    Corre en paralelo con `initialize`/`list_tools` del cliente y solo la primera consulta
+    real espera a que termine. Se limita a 15 s y se desactiva con MCP_WARMUP=0.
+    """
+    try:
+        with anyio.move_on_after(15) as scope:
+            try:
+                await cliente_compartido.client.models.list()
+            except Exception as e:  # noqa: BLE001 (workshop)
+                log.warning(f"⚠️  Precalentamiento fallido: {e}")
+                return
+        if scope.cancelled_caught:
+            log.warning("⚠️  Precalentamiento sin respuesta en 15 s; se continúa sin él")
+        else:
+            log.info("🔥 Conexión con el modelo precalentada")
+    finally:
+        if precalentado is not None:
+            precalentado.set()
 
 async def run_puente_enterprise():
     """Ejecutar el servidor MCP del Puente del Enterprise.
@@ -132,28 +217,39 @@ async def run_puente_enterprise():
     Este servidor expone múltiples especialistas que los oficiales pueden consultar.
     El protocolo MCP permite que cualquier cliente conecte y consulte a cualquier especialista.
     """
-    print("="*80, file=sys.stderr, flush=True)
-    print("🚀 SERVIDOR MCP: Puente del Enterprise", file=sys.stderr, flush=True)
-    print("="*80, file=sys.stderr, flush=True)
-    print("\n✅ Especialistas disponibles:", file=sys.stderr, flush=True)
+    log.info("="*80)
+    log.info("🚀 SERVIDOR MCP: Puente del Enterprise")
+    log.info("="*80)
+    log.info("\n✅ Especialistas disponibles:")
     for nombre in especialistas_puente.keys():
-        print(f"   ✓ {nombre}", file=sys.stderr, flush=True)
-    print("\n📡 Escuchando en stdin/stdout (protocolo MCP)", file=sys.stderr, flush=True)
-    print("⏳ Esperando consultas de oficiales del Enterprise...\n", file=sys.stderr, flush=True)
+        log.info(f"   ✓ {nombre}")
+    log.info("\n📡 Escuchando en stdin/stdout (protocolo MCP)")
+    log.info("⏳ Esperando consultas de oficiales del Enterprise...\n")
     
-    # Ejecutar servidor con protocolo MCP en stdio
-    async with stdio_server() as (read_stream, write_stream):
-        await servidor_principal.run(
-            read_stream,
-            write_stream,
-            servidor_principal.create_initialization_options()
-        )
+    global precalentado
+    async with anyio.create_task_group() as tg:
+        # El precalentamiento no retrasa el initialize del cliente: corre junto al servidor
+        if os.getenv("MCP_WARMUP", "1") == "1":
+            precalentado = anyio.Event()
+            tg.start_soon(precalentar_cliente)
+
+        # Ejecutar servidor con protocolo MCP en stdio
+        async with stdio_server() as (read_stream, write_stream):
+            await servidor_principal.run(
+                read_stream,
+                write_stream,
+                servidor_principal.create_initialization_options()
+            )
+        # Si el cliente cierra antes de que acabe, no hay que esperarlo
+        tg.cancel_scope.cancel()
 
 if __name__ == "__main__":
+    # uvloop acelera la E/S por pipes del stdio MCP; no existe en Windows (loop por defecto)
+    usar_uvloop = importlib.util.find_spec("uvloop") is not None
     try:
-        anyio.run(run_puente_enterprise)
+        anyio.run(run_puente_enterprise, backend_options={"use_uvloop": usar_uvloop})
     except KeyboardInterrupt:
-        print("\n\n🛑 Servidor MCP detenido por el usuario", file=sys.stderr, flush=True)
+        log.info("\n\n🛑 Servidor MCP detenido por el usuario")
     except Exception as e:
-        print(f"\n❌ Error en servidor MCP: {e}", file=sys.stderr, flush=True)
+        log.error(f"\n❌ Error en servidor MCP: {e}")
         raise